@@ -1,18 +1,28 @@
 import asyncio
-import json
+import base64
+import hashlib
 import os
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional
 
-import jwt
-import requests
+import aiohttp
+import ijson
+import orjson
+from cachetools import LRUCache, TLRUCache, TTLCache
 from bedrock_agentcore.identity.auth import requires_access_token
 from bedrock_agentcore.runtime import BedrockAgentCoreApp
 from strands import Agent, tool
 from strands.models.bedrock import BedrockModel
 
 # Environment settings
-os.environ["STRANDS_OTEL_ENABLE_CONSOLE_EXPORT"] = "true"
+# コンソールへのスパン出力は同期書き込みのため、本番では false で上書きできるようにする
+os.environ.setdefault("STRANDS_OTEL_ENABLE_CONSOLE_EXPORT", "true")
 os.environ["OTEL_PYTHON_EXCLUDED_URLS"] = "/ping,/invocations"
 
 # API endpoints
@@ -23,37 +33,71 @@ CONFLUENCE_API_BASE = "https://api.atlassian.com/ex/confluence"
 
 # HTTP status codes
 HTTP_OK = 200
-
-# Global variables for token management
-atlassian_access_token: Optional[str] = None
-atlassian_cloud_id: Optional[str] = None
-tool_name: Optional[str] = None
-token_metadata: dict = {}
-
-# Authentication keywords
-AUTH_KEYWORDS = [
-    "authentication",
-    "authorize",
-    "authorization",
-    "auth",
-    "sign in",
-    "login",
-    "access",
-    "permission",
-    "credential",
-    "認証",
-    "アクセス",
-    "許可",
-    "権限",
-    "ログイン",
-]
-
+HTTP_NOT_FOUND = 404
+
+# HTTP client settings
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+HTTP_CONNECTION_LIMIT = 20
+HTTP_CONNECTION_LIMIT_PER_HOST = 10
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_DNS_CACHE_TTL = 300
+
+# Page fields extracted from the streamed v2 page response (JSON prefix -> key)
+PAGE_STREAM_FIELDS = {
+    "id": "id",
+    "title": "title",
+    "spaceId": "spaceId",
+    "version.number": "version",
+    "body.storage.value": "content",
+    "status": "status",
+}
+
+# Maximum number of concurrent page fetches in bulk operations
+PAGE_FETCH_CONCURRENCY = 10
+
+# Streaming queue settings
+STREAMING_QUEUE_MAXSIZE = 64
+
+# Maximum number of sessions whose agents (conversation history) are kept
+SESSION_AGENT_CACHE_MAXSIZE = 128
+
+# Token decode cache settings
+TOKEN_CACHE_MAXSIZE = 1024
+TOKEN_CACHE_TTL = 3600
+
+# Atlassian lookup cache settings
+LOOKUP_CACHE_MAXSIZE = 256
+LOOKUP_CACHE_TTL = 3600
+
+# Cloud ID cache (keyed by token hash) and Space ID cache (keyed by cloud ID and key)
+cloud_id_cache = TTLCache(maxsize=LOOKUP_CACHE_MAXSIZE, ttl=LOOKUP_CACHE_TTL)
+space_id_cache = TTLCache(maxsize=LOOKUP_CACHE_MAXSIZE, ttl=LOOKUP_CACHE_TTL)
+
+# HTTP session shared by all invocations (keeps TLS connections alive)
+http_session: Optional[aiohttp.ClientSession] = None
+http_session_loop: Optional[asyncio.AbstractEventLoop] = None
 
 # ========================================
 # Helper Functions
 # ========================================
 
 
+def build_confluence_urls(cloud_id: str) -> dict:
+    """Cloud IDに対応するConfluence APIのURLを生成"""
+    wiki_base = f"{CONFLUENCE_API_BASE}/{cloud_id}/wiki"
+    return {
+        "search": f"{wiki_base}/rest/api/content/search",
+        "pages": f"{wiki_base}/api/v2/pages",
+        "spaces": f"{wiki_base}/api/v2/spaces",
+        "site": f"https://{cloud_id}.atlassian.net/wiki",
+    }
+
+
+def escape_cql_string(value: str) -> str:
+    """CQLの文字列リテラル（シングルクォート）用にエスケープ"""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
 def create_auth_headers(access_token: str) -> dict:
     """認証ヘッダーを生成"""
     return {
@@ -62,9 +106,14 @@ def create_auth_headers(access_token: str) -> dict:
     }
 
 
+def dumps_json(obj) -> str:
+    """オブジェクトをJSON文字列にシリアライズ（orjsonを使用）"""
+    return orjson.dumps(obj).decode()
+
+
 def create_auth_required_response(tool_name: str) -> str:
     """認証が必要な場合のレスポンスを生成"""
-    return json.dumps(
+    return dumps_json(
         {
             "auth_required": True,
             "message": f"Atlassian authentication is required for {tool_name}.",
@@ -72,22 +121,104 @@ def create_auth_required_response(tool_name: str) -> str:
     )
 
 
+def build_error_result(error_message: str, details: str = "") -> dict:
+    """エラー結果の辞書を生成"""
+    return {
+        "success": False,
+        "error": error_message,
+        "details": details,
+    }
+
+
 def create_error_response(error_message: str, details: str = "") -> str:
     """エラーレスポンスを生成"""
-    return json.dumps(
-        {
-            "success": False,
-            "error": error_message,
-            "details": details,
-        }
+    return dumps_json(build_error_result(error_message, details))
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Atlassian API呼び出し用のHTTPセッションを生成"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        ),
+        timeout=HTTP_TIMEOUT,
     )
 
 
+def get_http_session() -> aiohttp.ClientSession:
+    """プロセス共通のHTTPセッションを取得（未作成の場合は生成）"""
+    global http_session, http_session_loop
+
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+        # セッションは生成したイベントループに紐づくため、クローズ用に記録する
+        http_session_loop = asyncio.get_running_loop()
+    return http_session
+
+
+async def close_http_session() -> None:
+    """プロセス共通のHTTPセッションを、生成元のイベントループ上でクローズ"""
+    if http_session is None or http_session.closed:
+        return
+
+    if http_session_loop is asyncio.get_running_loop():
+        await http_session.close()
+    elif http_session_loop.is_running():
+        # エントリーポイントはワーカースレッドのループで実行されるため、そちらに委譲する
+        await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(http_session.close(), http_session_loop)
+        )
+
+
+def _token_info_ttu(_key: str, token_info: dict, now: float) -> float:
+    """キャッシュの有効期限（トークンのexpとTOKEN_CACHE_TTLの早い方）"""
+    exp = token_info.get("exp")
+    if isinstance(exp, (int, float)):
+        return min(exp, now + TOKEN_CACHE_TTL)
+    return now + TOKEN_CACHE_TTL
+
+
+# Decoded token cache (keyed by token hash)
+token_info_cache = TLRUCache(
+    maxsize=TOKEN_CACHE_MAXSIZE, ttu=_token_info_ttu, timer=time.time
+)
+token_info_cache_lock = threading.Lock()
+
+
+def get_token_cache_key(access_token: str) -> str:
+    """トークンキャッシュのキーを生成（トークン自体は保持しない）"""
+    return hashlib.sha256(access_token.encode()).hexdigest()[:32]
+
+
+def clear_token_cache() -> None:
+    """デコード済みトークンのキャッシュを破棄（ログアウト時など）"""
+    with token_info_cache_lock:
+        token_info_cache.clear()
+
+
+def decode_jwt_payload(access_token: str) -> dict:
+    """JWTのペイロード部をデコード（署名は検証しない）"""
+    payload_segment = access_token.split(".", 2)[1]
+    payload = orjson.loads(base64.urlsafe_b64decode(payload_segment + "=="))
+    if not isinstance(payload, dict):
+        raise ValueError("JWT payload is not a JSON object")
+    return payload
+
+
 def decode_token_info(access_token: str) -> dict:
-    """アクセストークンをデコードして情報を取得"""
+    """アクセストークンをデコードして情報を取得（結果はexpまでキャッシュ）"""
+    cache_key = get_token_cache_key(access_token)
+    with token_info_cache_lock:
+        token_info = token_info_cache.get(cache_key)
+    if token_info is not None:
+        return token_info
+
     try:
-        decoded = jwt.decode(access_token, options={"verify_signature": False})
-        return {
+        decoded = decode_jwt_payload(access_token)
+        token_info = {
             "iss": decoded.get("iss", "N/A"),
             "sub": decoded.get("sub", "N/A"),
             "aud": decoded.get("aud", "N/A"),
@@ -96,20 +227,35 @@ def decode_token_info(access_token: str) -> dict:
             "scopes": decoded.get("scope", "N/A"),
         }
     except Exception:
+        # デコード失敗時はキャッシュしない
         return {}
 
+    with token_info_cache_lock:
+        token_info_cache[cache_key] = token_info
+    return token_info
 
-def extract_response_text(response_message) -> str:
-    """レスポンスメッセージからテキストを抽出"""
-    if isinstance(response_message, dict):
-        content = response_message.get("content", [])
-        if isinstance(content, list):
-            return "".join(
-                item["text"]
-                for item in content
-                if isinstance(item, dict) and "text" in item
-            )
-    return str(response_message)
+
+def peek_token_exp(access_token: str) -> Optional[int]:
+    """トークンのexpを取得（デコード結果のキャッシュを利用）"""
+    exp = decode_token_info(access_token).get("exp")
+    return exp if isinstance(exp, int) else None
+
+
+def token_metadata_exp_str() -> Optional[str]:
+    """現在のリクエストのトークン有効期限を文字列で取得"""
+    exp = request_context.get().token_metadata.get("exp")
+    if exp is None:
+        return None
+    return datetime.fromtimestamp(exp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def extract_page_fields(stream: aiohttp.StreamReader) -> dict:
+    """ページのJSONをストリーミングで解析し、必要なフィールドのみ抽出"""
+    fields = {}
+    async for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix in PAGE_STREAM_FIELDS and event in ("string", "number"):
+            fields[PAGE_STREAM_FIELDS[prefix]] = value
+    return fields
 
 
 # ========================================
@@ -117,144 +263,229 @@ def extract_response_text(response_message) -> str:
 # ========================================
 
 
-def get_atlassian_cloud_id(access_token: str) -> Optional[str]:
-    """Atlassianのアクセス可能なリソースからCloud IDを取得"""
-    response = requests.get(
-        ATLASSIAN_ACCESSIBLE_RESOURCES_URL,
-        headers=create_auth_headers(access_token),
-    )
+async def get_atlassian_cloud_id(access_token: str, headers: dict) -> Optional[str]:
+    """Atlassianのアクセス可能なリソースからCloud IDを取得（トークンごとにキャッシュ）"""
+    cache_key = get_token_cache_key(access_token)
+    cloud_id = cloud_id_cache.get(cache_key)
+    if cloud_id is not None:
+        return cloud_id
 
-    if response.status_code == HTTP_OK:
-        resources = response.json()
-        if resources:
-            return resources[0]["id"]
+    ctx = request_context.get()
+
+    async with ctx.http_session.get(
+        ATLASSIAN_ACCESSIBLE_RESOURCES_URL, headers=headers
+    ) as response:
+        if response.status == HTTP_OK:
+            resources = orjson.loads(await response.read())
+            if resources:
+                cloud_id = resources[0]["id"]
+                cloud_id_cache[cache_key] = cloud_id
+                return cloud_id
 
     return None
 
 
-def get_space_id_by_key(space_key: str) -> Optional[str]:
-    """Space KeyからSpace IDを取得（v2 API用）"""
-    global atlassian_access_token, atlassian_cloud_id
+async def get_space_id_by_key(
+    cloud_id: str, spaces_url: str, headers: dict, space_key: str
+) -> Optional[str]:
+    """Space KeyからSpace IDを取得（v2 API用、Cloud IDとSpace Keyごとにキャッシュ）"""
+    space_id = space_id_cache.get((cloud_id, space_key))
+    if space_id is not None:
+        return space_id
 
-    api_url = f"{CONFLUENCE_API_BASE}/{atlassian_cloud_id}/wiki/api/v2/spaces"
-    params = {"keys": space_key, "limit": 1}
+    ctx = request_context.get()
 
-    response = requests.get(
-        api_url, headers=create_auth_headers(atlassian_access_token), params=params
-    )
+    params = {"keys": space_key, "limit": 1}
 
-    if response.status_code == HTTP_OK:
-        result = response.json()
-        spaces = result.get("results", [])
-        if spaces:
-            return spaces[0].get("id")
+    async with ctx.http_session.get(
+        spaces_url, headers=headers, params=params
+    ) as response:
+        if response.status == HTTP_OK:
+            result = orjson.loads(await response.read())
+            spaces = result.get("results", [])
+            if spaces:
+                space_id = spaces[0].get("id")
+                if space_id:
+                    space_id_cache[(cloud_id, space_key)] = space_id
+                return space_id
 
     return None
 
 
-# ========================================
-# Confluence Tool Functions
-# ========================================
+def invalidate_space_cache(space_key: str) -> None:
+    """指定したSpace KeyのSpace IDキャッシュを破棄"""
+    for cache_key in [key for key in space_id_cache if key[1] == space_key]:
+        space_id_cache.pop(cache_key, None)
 
 
-@tool
-def search_confluence_by_text(search_text: str, limit: int = 10) -> str:
-    """テキスト検索でConfluenceページを検索"""
-    global atlassian_access_token, atlassian_cloud_id, tool_name
-    tool_name = "search_confluence_by_text"
+async def fetch_confluence_page(page_id: str) -> dict:
+    """ページIDからページ詳細を取得し、結果を辞書で返す"""
+    ctx = request_context.get()
 
-    if not atlassian_access_token:
-        return create_auth_required_response(tool_name)
+    api_url = f"{ctx.urls['pages']}/{page_id}"
+    params = {"body-format": "storage"}  # v2ではbody-formatパラメータが必須
 
-    cql = f"type=page AND (title~'{search_text}' OR text~'{search_text}')"
-    api_url = f"{CONFLUENCE_API_BASE}/{atlassian_cloud_id}/wiki/rest/api/content/search"
-    params = {"cql": cql, "limit": limit}
+    async with ctx.http_session.get(
+        api_url, headers=ctx.headers, params=params
+    ) as response:
+        if response.status == HTTP_OK:
+            # ページ全体を辞書化せず、必要なフィールドのみストリーミングで抽出
+            page = await extract_page_fields(response.content)
 
-    response = requests.get(
-        api_url, headers=create_auth_headers(atlassian_access_token), params=params
-    )
-
-    if response.status_code == HTTP_OK:
-        result = response.json()
-        return json.dumps(
-            {
+            return {
                 "success": True,
-                "search_text": search_text,
-                "total": result.get("totalSize", 0),
-                "pages": [
-                    {
-                        "id": page["id"],
-                        "title": page["title"],
-                        "space": page.get("space", {}).get("name", "N/A"),
-                        "excerpt": page.get("excerpt", ""),
-                        "url": f"https://{atlassian_cloud_id}.atlassian.net/wiki{page['_links']['webui']}",
-                    }
-                    for page in result.get("results", [])
-                ],
+                "page": {
+                    "id": page.get("id"),
+                    "title": page.get("title"),
+                    "spaceId": page.get("spaceId"),
+                    "version": page.get("version", 1),
+                    "content": page.get("content", ""),
+                    "status": page.get("status"),
+                },
             }
+
+        return build_error_result(
+            f"Failed to get page: {response.status}", await response.text()
         )
 
-    return create_error_response(
-        f"Failed to search pages: {response.status_code}", response.text
-    )
+
+async def get_page_status(page_id: str) -> tuple[int, str]:
+    """指定されたIDのページを取得し、ステータスコードとレスポンス本文を返す"""
+    ctx = request_context.get()
+
+    api_url = f"{ctx.urls['pages']}/{page_id}"
+
+    async with ctx.http_session.get(api_url, headers=ctx.headers) as response:
+        # 本文はエラー詳細に使い、読み切ることで接続も再利用できる
+        return response.status, await response.text()
+
+
+# ========================================
+# Confluence Tool Functions
+# ========================================
+
+
+@tool
+async def search_confluence_by_text(
+    search_text: str, limit: int = 10, start: int = 0
+) -> str:
+    """テキスト検索でConfluenceページを検索（startで取得開始位置を指定してページング）"""
+    ctx = request_context.get()
+    ctx.tool_name = "search_confluence_by_text"
+
+    if not await ensure_authenticated():
+        return create_auth_required_response(ctx.tool_name)
+
+    escaped_text = escape_cql_string(search_text)
+    cql = f"type=page AND (title~'{escaped_text}' OR text~'{escaped_text}')"
+    # 表示に使うスペース情報のみ展開してレスポンスを小さく保つ
+    params = {"cql": cql, "limit": limit, "start": start, "expand": "space"}
+
+    async with ctx.http_session.get(
+        ctx.urls["search"], headers=ctx.headers, params=params
+    ) as response:
+        if response.status == HTTP_OK:
+            result = orjson.loads(await response.read())
+            return dumps_json(
+                {
+                    "success": True,
+                    "search_text": search_text,
+                    "total": result.get("totalSize", 0),
+                    "start": start,
+                    "pages": [
+                        {
+                            "id": page["id"],
+                            "title": page["title"],
+                            "space": page.get("space", {}).get("name", "N/A"),
+                            "excerpt": page.get("excerpt", ""),
+                            "url": f"{ctx.urls['site']}{page['_links']['webui']}",
+                        }
+                        for page in result.get("results", [])
+                    ],
+                }
+            )
+
+        return create_error_response(
+            f"Failed to search pages: {response.status}", await response.text()
+        )
 
 
 @tool
-def get_confluence_page(page_id: str) -> str:
+async def get_confluence_page(page_id: str) -> str:
     """指定されたIDのConfluenceページの詳細を取得"""
-    global atlassian_access_token, atlassian_cloud_id, tool_name
-    tool_name = "get_confluence_page"
+    ctx = request_context.get()
+    ctx.tool_name = "get_confluence_page"
 
-    if not atlassian_access_token:
-        return create_auth_required_response(tool_name)
+    if not await ensure_authenticated():
+        return create_auth_required_response(ctx.tool_name)
 
-    api_url = f"{CONFLUENCE_API_BASE}/{atlassian_cloud_id}/wiki/api/v2/pages/{page_id}"
-    params = {"body-format": "storage"}  # v2ではbody-formatパラメータが必須
+    return dumps_json(await fetch_confluence_page(page_id))
 
-    response = requests.get(
-        api_url, headers=create_auth_headers(atlassian_access_token), params=params
-    )
 
-    if response.status_code == HTTP_OK:
-        page = response.json()
-        body_content = page.get("body", {}).get("storage", {}).get("value", "")
+@tool
+async def get_confluence_pages(page_ids: list[str]) -> str:
+    """指定された複数IDのConfluenceページの詳細をまとめて取得"""
+    ctx = request_context.get()
+    ctx.tool_name = "get_confluence_pages"
 
-        return json.dumps(
-            {
-                "success": True,
-                "page": {
-                    "id": page.get("id"),
-                    "title": page.get("title"),
-                    "spaceId": page.get("spaceId"),
-                    "version": page.get("version", {}).get("number", 1),
-                    "content": body_content,
-                    "status": page.get("status"),
-                },
-            }
-        )
+    if not await ensure_authenticated():
+        return create_auth_required_response(ctx.tool_name)
+
+    # 同時リクエスト数を制限しつつ並行して取得
+    semaphore = asyncio.Semaphore(PAGE_FETCH_CONCURRENCY)
+
+    async def fetch_with_limit(page_id: str) -> dict:
+        async with semaphore:
+            try:
+                return await fetch_confluence_page(page_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 1ページの失敗で取得済みの他ページを失わないよう個別にエラー化
+                return build_error_result(f"Failed to get page: {page_id}", str(e))
+
+    results = await asyncio.gather(*(fetch_with_limit(pid) for pid in page_ids))
 
-    return create_error_response(
-        f"Failed to get page: {response.status_code}", response.text
+    return dumps_json(
+        {
+            "success": any(result["success"] for result in results),
+            "pages": results,
+        }
     )
 
 
 @tool
-def create_confluence_page(
+async def create_confluence_page(
     space_key: str, title: str, content: str, parent_id: Optional[str] = None
 ) -> str:
     """新しいConfluenceページを作成"""
-    global atlassian_access_token, atlassian_cloud_id, tool_name
-    tool_name = "create_confluence_page"
+    ctx = request_context.get()
+    ctx.tool_name = "create_confluence_page"
 
-    if not atlassian_access_token:
-        return create_auth_required_response(tool_name)
+    if not await ensure_authenticated():
+        return create_auth_required_response(ctx.tool_name)
+
+    # Space IDの取得（v2 API用）と親ページの存在確認を並行して実行
+    lookups = [
+        get_space_id_by_key(ctx.cloud_id, ctx.urls["spaces"], ctx.headers, space_key)
+    ]
+    if parent_id:
+        lookups.append(get_page_status(parent_id))
+    space_id, *parent_result = await asyncio.gather(*lookups)
 
-    # Space KeyからSpace IDを取得（v2 API用）
-    space_id = get_space_id_by_key(space_key)
     if not space_id:
         return create_error_response(
             f"Space not found: {space_key}", "指定されたSpace Keyが見つかりません"
         )
+    if parent_id:
+        parent_status, parent_body = parent_result[0]
+        if parent_status == HTTP_NOT_FOUND:
+            return create_error_response(
+                f"Parent page not found: {parent_id}",
+                "指定された親ページが見つかりません",
+            )
+        if parent_status != HTTP_OK:
+            return create_error_response(
+                f"Failed to check parent page: {parent_status}", parent_body
+            )
 
     # HTML形式でない場合はpタグで囲む
     if not content.startswith("<"):
@@ -274,28 +505,25 @@ def create_confluence_page(
     if parent_id:
         payload["parentId"] = parent_id
 
-    api_url = f"{CONFLUENCE_API_BASE}/{atlassian_cloud_id}/wiki/api/v2/pages"
-    headers = create_auth_headers(atlassian_access_token)
-    headers["Content-Type"] = "application/json"
-
-    response = requests.post(api_url, headers=headers, json=payload)
+    async with ctx.http_session.post(
+        ctx.urls["pages"], headers=ctx.json_headers, data=orjson.dumps(payload)
+    ) as response:
+        if response.status == HTTP_OK:
+            page = orjson.loads(await response.read())
+            return dumps_json(
+                {
+                    "success": True,
+                    "message": f"ページを作成しました: {page.get('title')}",
+                    "page_id": page.get("id"),
+                    "page_title": page.get("title"),
+                    "space_id": space_id,
+                }
+            )
 
-    if response.status_code == HTTP_OK:
-        page = response.json()
-        return json.dumps(
-            {
-                "success": True,
-                "message": f"ページを作成しました: {page.get('title')}",
-                "page_id": page.get("id"),
-                "page_title": page.get("title"),
-                "space_id": space_id,
-            }
+        return create_error_response(
+            f"Failed to create page: {response.status}", await response.text()
         )
 
-    return create_error_response(
-        f"Failed to create page: {response.status_code}", response.text
-    )
-
 
 # ========================================
 # Agent Configuration
@@ -306,24 +534,65 @@ SYSTEM_PROMPT = """あなたはユーザーのAtlassian Confluenceを操作す
 
 主な機能:
 - テキスト検索: キーワードでページを検索
-- ページ詳細取得: 特定ページの内容を表示
+- ページ詳細取得: 特定ページの内容を表示（複数ページはまとめて取得）
 - ページ作成: 新しいConfluenceページを作成
 
 操作が完了したら、結果を明確に伝えてください。"""
 
 model = BedrockModel(model_id="us.anthropic.claude-3-7-sonnet-20250219-v1:0")
 
-agent = Agent(
-    model=model,
-    system_prompt=SYSTEM_PROMPT,
-    tools=[
-        search_confluence_by_text,
-        get_confluence_page,
-        create_confluence_page,
-    ],
-)
 
-app = BedrockAgentCoreApp()
+def create_agent() -> Agent:
+    """セッション用のエージェントを生成（モデルは全セッションで共有）"""
+    return Agent(
+        model=model,
+        system_prompt=SYSTEM_PROMPT,
+        tools=[
+            search_confluence_by_text,
+            get_confluence_page,
+            get_confluence_pages,
+            create_confluence_page,
+        ],
+    )
+
+
+# Agents and their locks keyed by AgentCore session ID
+session_agents = LRUCache(maxsize=SESSION_AGENT_CACHE_MAXSIZE)
+
+
+def get_session_agent(session_id: Optional[str]) -> tuple[Agent, asyncio.Lock]:
+    """セッションIDに対応するエージェントとロックを取得（未作成の場合は生成）"""
+    entry = session_agents.get(session_id)
+    if entry is None:
+        entry = (create_agent(), asyncio.Lock())
+        session_agents[session_id] = entry
+    return entry
+
+
+def prewarm_model() -> None:
+    """Bedrockクライアントの接続を事前に確立し、初回リクエストの遅延を抑える"""
+    try:
+        # 共有モデルのクライアントを直接呼び出し、その接続プールを温める
+        model.client.converse(
+            modelId=model.get_config()["model_id"],
+            messages=[{"role": "user", "content": [{"text": "ping"}]}],
+            inferenceConfig={"maxTokens": 1},
+        )
+    except Exception as e:
+        print(f"Model prewarm failed: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    """アプリケーションの起動・終了処理"""
+    if os.environ.get("PREWARM"):
+        # 起動や/pingの応答を待たせないよう、完了を待たずにバックグラウンドで実行
+        asyncio.get_running_loop().run_in_executor(None, prewarm_model)
+    yield
+    await close_http_session()
+
+
+app = BedrockAgentCoreApp(lifespan=lifespan)
 
 
 # ========================================
@@ -331,32 +600,71 @@ app = BedrockAgentCoreApp()
 # ========================================
 
 
+# ストリーム終端を表す番兵（Noneをメッセージとして送れるよう専用オブジェクトを使う）
+_END_OF_STREAM = object()
+
+
 class StreamingQueue:
-    """エージェント実行中のメッセージストリーミング用キュー"""
+    """エージェント実行中のメッセージストリーミング用キュー（上限付き）"""
 
     def __init__(self):
-        self.finished = False
-        self.queue = asyncio.Queue()
+        self.closed = False
+        self.queue = asyncio.Queue(maxsize=STREAMING_QUEUE_MAXSIZE)
 
     async def put(self, item):
-        """キューにアイテムを追加"""
+        """キューにアイテムを追加（満杯の場合は消費されるまで待機）"""
+        if self.closed:
+            return
         await self.queue.put(item)
 
     async def finish(self):
         """キューを終了状態にする"""
-        self.finished = True
-        await self.queue.put(None)
+        await self.put(_END_OF_STREAM)
 
     async def stream(self):
         """キューからアイテムをストリーミング"""
-        while True:
-            item = await self.queue.get()
-            if item is None and self.finished:
-                break
-            yield item
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is _END_OF_STREAM:
+                    return
+                yield item
+        finally:
+            # 消費側が終了した後は追加を受け付けない
+            self.closed = True
 
 
-queue = StreamingQueue()
+# ========================================
+# Request Context
+# ========================================
+
+
+@dataclass
+class RequestContext:
+    """リクエスト単位の状態（トークン・キュー・HTTPセッション）"""
+
+    queue: StreamingQueue
+    http_session: aiohttp.ClientSession
+    token: Optional[str] = None
+    cloud_id: Optional[str] = None
+    tool_name: Optional[str] = None
+    token_metadata: dict = field(default_factory=dict)
+    urls: dict = field(default_factory=dict)
+    headers: dict = field(default_factory=dict)
+    json_headers: dict = field(default_factory=dict)
+    auth_attempted: bool = False
+    auth_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def clear_authentication(self):
+        """認証状態（トークン・Cloud ID・ヘッダー・URL）を破棄"""
+        self.token = None
+        self.cloud_id = None
+        self.headers = {}
+        self.json_headers = {}
+        self.urls = {}
+
+
+request_context: ContextVar[RequestContext] = ContextVar("request_context")
 
 
 # ========================================
@@ -364,20 +672,51 @@ queue = StreamingQueue()
 # ========================================
 
 
+def write_console(message: str) -> None:
+    """標準出力にメッセージを書き込んでフラッシュ"""
+    sys.stdout.write(message)
+    sys.stdout.flush()
+
+
 async def on_auth_url(url: str):
     """認証URLが生成された際のコールバック"""
     separator = "=" * 80
-    print(f"\n{separator}")
-    print("🔐 AUTHORIZATION REQUIRED")
-    print(f"{separator}")
-    print(f"\nPlease copy and paste this URL in your browser:\n{url}\n")
-    print(f"{separator}\n")
-    await queue.put(f"Authorization url: {url}")
+    message = (
+        f"\n{separator}\n"
+        "🔐 AUTHORIZATION REQUIRED\n"
+        f"{separator}\n"
+        f"\nPlease copy and paste this URL in your browser:\n{url}\n\n"
+        f"{separator}\n\n"
+    )
+    # 標準出力への書き込みでイベントループを止めないよう別スレッドで一括出力
+    await asyncio.get_running_loop().run_in_executor(None, write_console, message)
+    await request_context.get().queue.put(f"Authorization url: {url}")
 
 
-def needs_authentication(response_text: str) -> bool:
-    """レスポンステキストから認証が必要かどうかを判定"""
-    return any(keyword.lower() in response_text.lower() for keyword in AUTH_KEYWORDS)
+async def authenticate() -> bool:
+    """
+    Atlassianトークンを取得し、Cloud IDとAPIのURLをコンテキストに設定
+
+    Returns:
+        bool: Cloud IDまで取得できた場合True、取得できなかった場合False
+    """
+    ctx = request_context.get()
+
+    try:
+        await need_atlassian_token_async(access_token=None)
+        ctx.cloud_id = await get_atlassian_cloud_id(ctx.token, ctx.headers)
+        if ctx.cloud_id:
+            # 以降のツール呼び出しで使うURLを一度だけ生成
+            ctx.urls = build_confluence_urls(ctx.cloud_id)
+            return True
+    except Exception:
+        # トークンだけが残るとツールがURL未設定のまま実行されるため破棄する
+        ctx.clear_authentication()
+        raise
+
+    # Cloud IDが無いとAPIを呼べないため、ツールからは未認証として扱う
+    ctx.clear_authentication()
+    return False
 
 
 async def handle_authentication() -> bool:
@@ -387,43 +726,62 @@ async def handle_authentication() -> bool:
     Returns:
         bool: 認証が成功した場合True、失敗した場合False
     """
-    global atlassian_access_token, atlassian_cloud_id, tool_name
+    ctx = request_context.get()
 
-    await queue.put(
-        f"Authentication required for {tool_name} access. Starting authorization flow..."
+    await ctx.queue.put(
+        f"Authentication required for {ctx.tool_name} access. Starting authorization flow..."
     )
 
     try:
-        atlassian_access_token = await need_atlassian_token_async(access_token=None)
-        atlassian_cloud_id = get_atlassian_cloud_id(atlassian_access_token)
-
-        if atlassian_cloud_id:
-            await queue.put(
-                f"Authentication successful! Atlassian Cloud ID: {atlassian_cloud_id}"
+        if await authenticate():
+            await ctx.queue.put(
+                f"Authentication successful! Atlassian Cloud ID: {ctx.cloud_id}"
             )
-            await queue.put(f"Retrying {tool_name}...")
             return True
         else:
-            await queue.put("Failed to obtain Atlassian Cloud ID")
+            await ctx.queue.put("Failed to obtain Atlassian Cloud ID")
             return False
 
     except Exception as auth_error:
-        await queue.put(f"Authentication failed: {str(auth_error)}")
+        await ctx.queue.put(f"Authentication failed: {str(auth_error)}")
         return False
 
 
-async def agent_task(user_message: str):
+async def ensure_authenticated() -> bool:
+    """
+    ツールの初回利用時に認証処理を実行（リクエスト内で一度だけ試行）
+
+    Returns:
+        bool: 認証済みの場合True、認証できなかった場合False
+    """
+    ctx = request_context.get()
+    if ctx.token:
+        return True
+
+    # 並行実行されたツールが認証フローを重複して開始しないよう直列化する
+    async with ctx.auth_lock:
+        if not ctx.token and not ctx.auth_attempted:
+            ctx.auth_attempted = True
+            await handle_authentication()
+    return ctx.token is not None
+
+
+async def agent_task(user_message: str, session_id: Optional[str]):
     """エージェントタスクを実行"""
+    queue = request_context.get().queue
+
     try:
         await queue.put("Begin agent execution")
 
-        response = agent(user_message)
-        response_text = extract_response_text(response.message)
+        # 会話履歴はセッション単位で保持し、他のセッションとは共有しない
+        agent, agent_lock = get_session_agent(session_id)
 
-        # 認証が必要な場合は認証処理を実行してリトライ
-        if needs_authentication(response_text):
-            if await handle_authentication():
-                response = agent(user_message)
+        # 非同期APIで呼び出し、モデル推論やツールのHTTP通信中もイベントループを解放する
+        # （agent(...) や asyncio.to_thread では別スレッドの別ループでツールが実行され、
+        #   request_context やHTTPセッションを共有できないため使用しない）
+        # 同一セッションの同時呼び出しで会話履歴が競合しないよう直列化する
+        async with agent_lock:
+            response = await agent.invoke_async(user_message)
 
         await queue.put(response.message)
         await queue.put("End agent execution")
@@ -450,16 +808,15 @@ async def need_atlassian_token_async(*, access_token: str) -> str:
     Returns:
         str: アクセストークン
     """
-    global atlassian_access_token, token_metadata
+    ctx = request_context.get()
 
-    # トークン情報をデコードしてメタデータに保存
-    token_info = decode_token_info(access_token)
-    if token_info and token_info.get("exp") != "N/A":
-        exp_timestamp = token_info["exp"]
-        exp_datetime = datetime.fromtimestamp(exp_timestamp)
-        token_metadata["exp_time"] = exp_datetime.strftime("%Y-%m-%d %H:%M:%S")
+    # 有効期限のみ保持し、表示用の整形は必要になった時点で行う
+    ctx.token_metadata["exp"] = peek_token_exp(access_token)
 
-    atlassian_access_token = access_token
+    # トークン確定時にリクエストヘッダーを一度だけ生成
+    ctx.token = access_token
+    ctx.headers = create_auth_headers(access_token)
+    ctx.json_headers = {**ctx.headers, "Content-Type": "application/json"}
     return access_token
 
 
@@ -469,24 +826,34 @@ async def need_atlassian_token_async(*, access_token: str) -> str:
 
 
 @app.entrypoint
-async def agent_invocation(payload: dict):
+async def agent_invocation(payload: dict, context):
     """
     エージェント呼び出しのエントリーポイント
 
     Args:
         payload: リクエストペイロード
+        context: AgentCoreのリクエストコンテキスト（セッションIDを含む）
 
     Returns:
         AsyncGenerator: ストリーミングレスポンス
     """
     user_message = payload.get("prompt", "No prompt found in input")
-    task = asyncio.create_task(agent_task(user_message))
+
+    # リクエストごとにコンテキストを分離（タスクはContextVarを引き継ぐ）
+    ctx = RequestContext(queue=StreamingQueue(), http_session=get_http_session())
+    request_context.set(ctx)
+    task = asyncio.create_task(agent_task(user_message, context.session_id))
 
     async def stream_with_task():
         """タスク実行とストリーミングを並行処理"""
-        async for item in queue.stream():
-            yield item
-        await task
+        try:
+            async for item in ctx.queue.stream():
+                yield item
+            await task
+        finally:
+            # クライアント切断などで消費が中断された場合はタスクも停止する
+            if not task.done():
+                task.cancel()
 
     return stream_with_task()
 